@@ -0,0 +1,13 @@
+bind = '0.0.0.0:5004'
+# Single worker: the assignment journal, its compaction and the in-memory
+# caches in server.py assume one writer process (compaction across workers
+# can drop a concurrent append). The gthread pool below already handles
+# concurrent uploads; add cross-process file locking before raising this.
+workers = 1
+threads = 8
+worker_class = 'gthread'
+keepalive = 30
+preload_app = True
+# Lets the kernel spread accepted connections across workers should
+# `workers` ever be raised (gunicorn >= 21); harmless with one worker
+reuse_port = True
@@ -1,139 +1,443 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, send_from_directory, Response
 from flask_cors import CORS # Need to install: pip install flask-cors
+from werkzeug.security import safe_join
+from werkzeug.utils import secure_filename
 import os
 import time
 import json
+import copy
+import queue
 import random
+import shutil
+import threading
+
+try:
+    import orjson  # Optional: pip install orjson (2-5x faster JSON decode)
+    _jloads = orjson.loads
+    _jdumps = orjson.dumps
+except ImportError:
+    _jloads = json.loads
+    _jdumps = lambda obj: json.dumps(obj).encode('utf-8')
+
+try:
+    from flask_compress import Compress  # Optional: pip install flask-compress
+except ImportError:
+    Compress = None
 
 app = Flask(__name__, static_folder='static')
-CORS(app) # Enable CORS for all routes
+app.url_map.strict_slashes = False  # No 308 redirect on trailing-slash typos
+# Scope CORS to the API and let browsers cache the preflight for a day,
+# so each cross-origin POST costs one request instead of two
+CORS(app, max_age=86400, resources={r"/api/*": {
+    "origins": "*",
+    "methods": ["GET", "POST"],
+    "allow_headers": ["Content-Type", "X-Participant-Id"],
+}})
+
+if Compress is not None:
+    # Gzip CSV/JSON responses; result CSVs are highly redundant text and
+    # typically shrink ~10x, so downloads become bandwidth-cheap
+    app.config['COMPRESS_MIMETYPES'] = ['text/csv', 'application/json', 'text/html', 'application/javascript']
+    app.config['COMPRESS_LEVEL'] = 5
+    app.config['COMPRESS_MIN_SIZE'] = 1024
+    Compress(app)
 
 # Configuration
 DATA_DIR = 'data'
 
-if not os.path.exists(DATA_DIR):
-    os.makedirs(DATA_DIR)
+# Bound once at import: the absolute path spares the kernel re-resolving
+# relative components on every open, and the local time reference skips
+# the module attribute lookup in hot handlers
+DATA_DIR_ABS = os.path.abspath(DATA_DIR)
+_time = time.time
+
+# When set (e.g. '/_protected'), file transfers are offloaded to the
+# front-end web server via X-Accel-Redirect instead of being streamed
+# through Python. See README_deploy.md for the matching nginx config.
+XACCEL_PREFIX = os.environ.get('XACCEL_PREFIX')
+
+def json_response(obj, status=200):
+    # Serialize through _jdumps (orjson when installed) instead of jsonify
+    return app.response_class(_jdumps(obj), status=status, mimetype='application/json')
+
+def send_page(filename):
+    # Serve an HTML page from the deploy root, via nginx when offloading
+    # is enabled so no file bytes move through Python
+    if XACCEL_PREFIX:
+        return Response('', headers={
+            'X-Accel-Redirect': f'{XACCEL_PREFIX}/{filename}',
+            'Content-Type': 'text/html; charset=utf-8',
+        })
+    return send_from_directory('.', filename)
+
+os.makedirs(DATA_DIR, exist_ok=True)
+
+@app.after_request
+def add_static_cache_headers(response):
+    # Assets under /static/ are plain-named (no content hash or version
+    # token in the URL), so a year-long immutable policy would pin
+    # returning participants to a stale experiment.js with no way to bust
+    # it. Keep the cache window short; after it expires the ETag handling
+    # built into Flask's static route turns unchanged reloads into 304s
+    if request.path.startswith('/static/'):
+        response.headers['Cache-Control'] = 'public, max-age=3600'
+    return response
 
 @app.route('/')
 def index():
     # Helper to serve the main experiment file from the repo root path
-    return send_from_directory('.', 'index.html')
+    return send_page('index.html')
+
+
+# Saved CSVs are fsync'd from a background thread in small batches, so an
+# acknowledged upload survives a crash without stalling the request on a
+# disk barrier
+_FSYNC_QUEUE = queue.SimpleQueue()
+_FSYNC_THREAD = None
+_FSYNC_THREAD_LOCK = threading.Lock()
+
+def _fsync_worker():
+    while True:
+        paths = [_FSYNC_QUEUE.get()]
+        while len(paths) < 32:
+            try:
+                paths.append(_FSYNC_QUEUE.get(timeout=0.05))
+            except queue.Empty:
+                break
+        for path in paths:
+            try:
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            except OSError:
+                pass  # File may have been removed; nothing to sync
+
+def _safe_name_prefix(participant_id):
+    # Participant ids become filename prefixes, so strip anything that
+    # could escape DATA_DIR (slashes, '..', etc.). Only the on-disk name
+    # is sanitized; the raw id still keys the assignment state.
+    return secure_filename(str(participant_id)) or 'unknown'
+
+def _queue_fsync(path):
+    # The worker thread is started lazily on first use so it lives in the
+    # serving process: with preload_app the module imports in the gunicorn
+    # master, and threads do not survive the fork into workers
+    global _FSYNC_THREAD
+    if _FSYNC_THREAD is None:
+        with _FSYNC_THREAD_LOCK:
+            if _FSYNC_THREAD is None:
+                _FSYNC_THREAD = threading.Thread(target=_fsync_worker, daemon=True)
+                _FSYNC_THREAD.start()
+    _FSYNC_QUEUE.put(path)
 
 
 @app.route('/api/save_data', methods=['POST'])
 def save_data():
     try:
-        data = request.json
+        try:
+            # cache=False: don't keep the raw body around once it is parsed,
+            # which matters for multi-MB CSV uploads
+            data = _jloads(request.get_data(cache=False))
+        except ValueError:
+            # Malformed JSON is a client error, not a 500
+            return json_response({'status': 'error', 'message': 'Invalid JSON body'}, 400)
         participant_id = data.get('participantId', 'unknown')
         csv_content = data.get('csvData', '')
-        
+
         if not csv_content:
-            return jsonify({'status': 'error', 'message': 'No CSV data provided'}), 400
+            return json_response({'status': 'error', 'message': 'No CSV data provided'}, 400)
 
-        timestamp = int(time.time())
-        filename = f"{participant_id}_{timestamp}.csv"
-        filepath = os.path.join(DATA_DIR, filename)
+        timestamp = int(_time())
+        filename = f"{_safe_name_prefix(participant_id)}_{timestamp}.csv"
+        filepath = os.path.join(DATA_DIR_ABS, filename)
 
-        with open(filepath, 'w', encoding='utf-8') as f:
-            f.write(csv_content)
+        csv_bytes = csv_content.encode('utf-8')
+        # Write to a temp name and publish with an atomic rename, so a
+        # concurrent viewer can never read a partially written CSV
+        tmp_path = filepath + '.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            try:
+                if len(csv_bytes) > 65536 and hasattr(os, 'posix_fallocate'):
+                    # Reserve the extents up front so a large body updates
+                    # only data blocks instead of growing the file
+                    # incrementally; sub-page payloads gain nothing
+                    os.posix_fallocate(fd, 0, len(csv_bytes))
+                # Single write(2) for typical payloads; the loop covers the
+                # partial-write case on very large bodies
+                written = 0
+                while written < len(csv_bytes):
+                    written += os.write(fd, csv_bytes[written:])
+            finally:
+                os.close(fd)
+            os.replace(tmp_path, filepath)
+        except:
+            os.unlink(tmp_path)
+            raise
+        _queue_fsync(filepath)
+        _note_saved_csv(filename)
 
         print(f"Saved data for participant {participant_id} to {filepath}")
         
-        # Mark assignment as completed in assignments.json
-        try:
-            state = load_assignments()
-            
-            # Remove from active
-            if participant_id in state['active']:
-                # Get the group they were assigned to
-                group = str(state['active'][participant_id]['group'])
-                del state['active'][participant_id]
-                
-                # Increment completed
-                if 'completed' not in state: 
-                    state['completed'] = {'0': 0, '1': 0, '2': 0}
-                if group not in state['completed']: 
-                    state['completed'][group] = 0
-                
-                state['completed'][group] += 1
-                
-                save_assignments(state)
-                print(f"Marked {participant_id} (Group {group}) as completed.")
-                
-        except Exception as e:
-            print(f"Warning: Failed to update assignment stats: {e}")
-        
-        return jsonify({'status': 'success', 'filename': filename})
+        mark_participant_completed(participant_id)
+
+        return json_response({'status': 'success', 'filename': filename})
+
+    except Exception as e:
+        print(f"Error saving data: {str(e)}")
+        return json_response({'status': 'error', 'message': str(e)}, 500)
+
+
+@app.route('/api/save_csv_stream', methods=['POST'])
+def save_csv_stream():
+    # Streaming alternative to /api/save_data: the raw CSV is the request
+    # body (Content-Type: text/csv) with the participant id in a header,
+    # so the upload is spooled to disk in 1 MiB chunks instead of being
+    # materialized as a JSON-wrapped string in memory
+    participant_id = request.headers.get('X-Participant-Id', 'unknown')
 
+    timestamp = int(_time())
+    filename = f"{_safe_name_prefix(participant_id)}_{timestamp}.csv"
+    filepath = os.path.join(DATA_DIR_ABS, filename)
+    tmp_path = filepath + '.tmp'
+
+    try:
+        with open(tmp_path, 'wb') as f:
+            shutil.copyfileobj(request.stream, f, length=1 << 20)
+        if os.path.getsize(tmp_path) == 0:
+            os.unlink(tmp_path)
+            return json_response({'status': 'error', 'message': 'No CSV data provided'}, 400)
+        os.replace(tmp_path, filepath)
     except Exception as e:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
         print(f"Error saving data: {str(e)}")
-        return jsonify({'status': 'error', 'message': str(e)}), 500
+        return json_response({'status': 'error', 'message': str(e)}, 500)
+
+    _queue_fsync(filepath)
+    _note_saved_csv(filename)
+    print(f"Saved data for participant {participant_id} to {filepath}")
+
+    mark_participant_completed(participant_id)
+
+    return json_response({'status': 'success', 'filename': filename})
 
 
 # --- Data Viewing Routes ---
 
 @app.route('/view')
 def view_data_page():
-    return send_from_directory('.', 'view_data.html')
+    return send_page('view_data.html')
 
 @app.route('/images')
 def image_viewer_page():
-    return send_from_directory('.', 'image_viewer.html')
+    return send_page('image_viewer.html')
+
+# Cache the listing keyed by directory mtime so repeat hits cost one stat
+# instead of a full directory read (the dir mtime bumps on any add/remove).
+# The serialized response body is cached alongside so hot hits skip JSON
+# encoding entirely.
+_LIST_DATA_CACHE = {'mtime': 0, 'files': [], 'body': b'[]'}
+_LIST_DATA_LOCK = threading.Lock()
+
+def _note_saved_csv(filename):
+    # Invalidate the cached listing so the next /api/list_data hit rescans.
+    # Appending just our own file and stamping the current dir mtime would
+    # silently absorb CSVs saved by *other* gunicorn workers since our last
+    # rescan — the stamped mtime would match the directory and those files
+    # would stay invisible to the viewer indefinitely.
+    with _LIST_DATA_LOCK:
+        _LIST_DATA_CACHE['mtime'] = 0
 
 @app.route('/api/list_data')
 def list_data():
-    if not os.path.exists(DATA_DIR):
+    try:
+        mtime = os.stat(DATA_DIR_ABS).st_mtime_ns
+    except FileNotFoundError:
         return jsonify([])
-    files = [f for f in os.listdir(DATA_DIR) if f.endswith('.csv')]
-    return jsonify(files)
+    with _LIST_DATA_LOCK:
+        if mtime != _LIST_DATA_CACHE['mtime']:
+            with os.scandir(DATA_DIR_ABS) as it:
+                _LIST_DATA_CACHE['files'] = [e.name for e in it if e.name.endswith('.csv')]
+            _LIST_DATA_CACHE['body'] = _jdumps(_LIST_DATA_CACHE['files'])
+            _LIST_DATA_CACHE['mtime'] = mtime
+        body = _LIST_DATA_CACHE['body']
+    return app.response_class(body, mimetype='application/json')
 
 @app.route('/api/get_data/<path:filename>')
 def get_data_file(filename):
-    return send_from_directory(DATA_DIR, filename, as_attachment=False)
+    if XACCEL_PREFIX:
+        # Validate the name before handing it to nginx: the redirect header
+        # bypasses the safe_join check send_from_directory would do, and
+        # nginx normalizes ../ inside the internal location. Data files are
+        # flat, so any separator is also rejected outright.
+        if '/' in filename or '\\' in filename or safe_join(DATA_DIR_ABS, filename) is None:
+            return json_response({'status': 'error', 'message': 'Invalid filename'}, 404)
+        # Zero bytes move through Python; nginx serves the file itself
+        return Response('', headers={
+            'X-Accel-Redirect': f'{XACCEL_PREFIX}/data/{filename}',
+            'Content-Type': 'text/csv',
+        })
+    # Saved CSVs never change after upload, so let the browser cache them
+    # for a few minutes instead of re-downloading on every viewer refresh.
+    # conditional=True also advertises Accept-Ranges and honors Range
+    # headers, so a viewer can page through a large CSV, and routes the
+    # transfer through wsgi.file_wrapper (sendfile under gunicorn)
+    resp = send_from_directory(DATA_DIR_ABS, filename, as_attachment=False,
+                               conditional=True, max_age=300)
+    resp.cache_control.public = True
+    return resp
 
 # --- Smart Assignment System ---
 
-ASSIGNMENTS_FILE = os.path.join(DATA_DIR, 'assignments.json')
+ASSIGNMENTS_FILE = os.path.join(DATA_DIR_ABS, 'assignments.json')
+ASSIGNMENTS_LOG = ASSIGNMENTS_FILE + '.log'
 ASSIGNMENT_TIMEOUT_SECONDS = 30 * 60  # 30 minutes to complete, otherwise considered abandoned
+COMPACT_LOG_BYTES = 1024 * 1024  # Rewrite the snapshot once the journal grows past this
+
+def _apply_assignment_event(state, event):
+    if event['event'] == 'assign':
+        state['active'][event['pid']] = {'group': event['group'], 'timestamp': event['timestamp']}
+    elif event['event'] == 'complete':
+        state['active'].pop(event['pid'], None)
+        group = str(event['group'])
+        if 'completed' not in state:
+            state['completed'] = {'0': 0, '1': 0, '2': 0}
+        state['completed'][group] = state['completed'].get(group, 0) + 1
+
+# Serializes journal appends, compaction and file reads within this
+# process (reentrant: compaction loads state while holding it). NOTE:
+# multiple gunicorn workers would still race each other on compaction;
+# that needs file locking or a single designated compacting worker, so
+# keep workers=1 if assignment traffic ever matters enough.
+_ASSIGN_LOCK = threading.RLock()
+
+# Parsed state cached behind the files' stat info; the server is the sole
+# writer, so a matching mtime+size means the cached copy is still current.
+# Key and state are updated together under their own lock so a reader
+# can never match a new key against an old state.
+_ASSIGN_CACHE = {'key': None, 'state': None}
+_ASSIGN_CACHE_LOCK = threading.Lock()
+
+def _drop_stale_sessions(state):
+    # Filter timed-out sessions on every read, so group load and the
+    # 'existing' check never see abandoned entries. Compaction snapshots
+    # the filtered state, which also retires their events from the journal.
+    now = _time()
+    active = state.get('active', {})
+    state['active'] = {pid: info for pid, info in active.items()
+                       if (now - info['timestamp']) < ASSIGNMENT_TIMEOUT_SECONDS}
+    return state
+
+def _assignments_stat_key():
+    key = []
+    for path in (ASSIGNMENTS_FILE, ASSIGNMENTS_LOG):
+        try:
+            st = os.stat(path)
+            key.append((st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            key.append(None)
+    return tuple(key)
 
 def load_assignments():
-    if not os.path.exists(ASSIGNMENTS_FILE):
-        return {'active': {}, 'completed': {'0': 0, '1': 0, '2': 0}}
+    key = _assignments_stat_key()
+    with _ASSIGN_CACHE_LOCK:
+        if key == _ASSIGN_CACHE['key']:
+            # Hand out a copy so handlers can mutate freely without
+            # corrupting the cached state
+            return _drop_stale_sessions(copy.deepcopy(_ASSIGN_CACHE['state']))
+    # State is the last compacted snapshot plus a replay of the journal
+    # tail; read both under the lock so we never observe the new snapshot
+    # together with the not-yet-truncated log mid-compaction
+    with _ASSIGN_LOCK:
+        key = _assignments_stat_key()
+        state = {'active': {}, 'completed': {'0': 0, '1': 0, '2': 0}}
+        try:
+            with open(ASSIGNMENTS_FILE, 'rb') as f:
+                state = _jloads(f.read())
+        except:
+            pass
+        try:
+            with open(ASSIGNMENTS_LOG, 'rb') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        _apply_assignment_event(state, _jloads(line))
+                    except:
+                        continue  # Skip a partially written trailing line
+        except FileNotFoundError:
+            pass
+    with _ASSIGN_CACHE_LOCK:
+        _ASSIGN_CACHE['key'] = key
+        _ASSIGN_CACHE['state'] = copy.deepcopy(state)
+    return _drop_stale_sessions(state)
+
+def append_assignment_event(event):
+    # Append one JSONL line instead of rewriting the whole state per event.
+    # The lock keeps appends and compaction serialized within this process;
+    # without it an append landing between another thread's load and its
+    # log truncation would be silently dropped.
+    with _ASSIGN_LOCK:
+        with open(ASSIGNMENTS_LOG, 'a') as f:
+            f.write(json.dumps(event) + '\n')
+        if os.path.getsize(ASSIGNMENTS_LOG) > COMPACT_LOG_BYTES:
+            compact_assignments()
+
+def compact_assignments():
+    with _ASSIGN_LOCK:
+        state = load_assignments()
+        # Publish the snapshot atomically (same temp-file + rename pattern
+        # as save_data) so a concurrent reader never sees a partial dump
+        tmp_path = ASSIGNMENTS_FILE + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f, indent=4)
+        os.replace(tmp_path, ASSIGNMENTS_FILE)
+        open(ASSIGNMENTS_LOG, 'w').close()
+
+def mark_participant_completed(participant_id):
+    # Mark assignment as completed in assignments.json
     try:
-        with open(ASSIGNMENTS_FILE, 'r') as f:
-            return json.load(f)
-    except:
-        return {'active': {}, 'completed': {'0': 0, '1': 0, '2': 0}}
+        state = load_assignments()
 
-def save_assignments(data):
-    with open(ASSIGNMENTS_FILE, 'w') as f:
-        json.dump(data, f, indent=4)
+        # Remove from active
+        if participant_id in state['active']:
+            # Get the group they were assigned to
+            group = str(state['active'][participant_id]['group'])
+            append_assignment_event({'event': 'complete', 'pid': participant_id, 'group': group})
+            print(f"Marked {participant_id} (Group {group}) as completed.")
+
+    except Exception as e:
+        print(f"Warning: Failed to update assignment stats: {e}")
 
 @app.route('/api/assign', methods=['POST'])
 def assign_group():
-    data = request.json
+    try:
+        data = _jloads(request.get_data(cache=False))
+    except ValueError:
+        return json_response({'error': 'invalid JSON body'}, 400)
     participant_id = data.get('participantId')
-    
+
     if not participant_id:
-        return jsonify({'error': 'no participant id'}), 400
+        return json_response({'error': 'no participant id'}, 400)
     
     lock_file = ASSIGNMENTS_FILE + '.lock'
     # Simple file locking could be better, but sufficient for low traffic
     
     state = load_assignments()
     
-    # Prune stale active sessions
-    now = time.time()
-    active = state.get('active', {})
-    
-    # Remove sessions older than timeout
-    fresh_active = {pid: info for pid, info in active.items() 
-                   if (now - info['timestamp']) < ASSIGNMENT_TIMEOUT_SECONDS}
-    state['active'] = fresh_active
-    
+    now = _time()
+    # load_assignments already filtered out sessions older than the timeout
+    fresh_active = state.get('active', {})
+
     # Check if this participant is already active
     if participant_id in fresh_active:
-        return jsonify({'group': fresh_active[participant_id]['group'], 'status': 'existing'})
+        return json_response({'group': fresh_active[participant_id]['group'], 'status': 'existing'})
         
     # Calculate load per group: Completed + Active
     # Initialize counts
@@ -157,15 +461,15 @@ def assign_group():
     assigned_group = random.choice(candidates)
     
     # Record assignment
-    state['active'][participant_id] = {
+    append_assignment_event({
+        'event': 'assign',
+        'pid': participant_id,
         'group': assigned_group,
         'timestamp': now
-    }
-    
-    save_assignments(state)
+    })
     
     print(f"Assigned {participant_id} to Group {assigned_group} (Loads: {counts})")
-    return jsonify({'group': assigned_group, 'status': 'new'})
+    return json_response({'group': assigned_group, 'status': 'new'})
 
 # Modify save_data to update completion status
 # We hook into the existing route by wrapping the logic or just editing it below
@@ -178,6 +482,13 @@ def assign_group():
 # and I will make a VERY targeted edit to `save_data` next.
 
 if __name__ == '__main__':
+    # Development fallback only; in production run through gunicorn so
+    # concurrent uploads are not serialized on one thread:
+    #   gunicorn -c gunicorn.conf.py wsgi:app
+    # FLASK_DEBUG=1 re-enables the debugger for local work; the reloader
+    # stays off either way since its stat loop over every loaded module
+    # costs CPU continuously
+    debug = os.environ.get('FLASK_DEBUG') == '1'
     print(f"Starting server on http://localhost:5004")
-    print(f"Data will be saved to: {os.path.abspath(DATA_DIR)}")
-    app.run(host='0.0.0.0', port=5004, debug=True)
+    print(f"Data will be saved to: {DATA_DIR_ABS}")
+    app.run(host='0.0.0.0', port=5004, debug=debug, use_reloader=False, threaded=True)
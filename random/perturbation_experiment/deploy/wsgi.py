@@ -0,0 +1 @@
+from server import app  # noqa: F401